@@ -19,6 +19,14 @@ _default_configs_paths = [
 for i in range(len(_default_configs_paths)):
     _default_configs_paths[i] = os.path.expandvars(_default_configs_paths[i])
 
+_default_cache_path = os.path.expandvars(
+    r"%LOCALAPPDATA%\scdl\cache.sqlite"
+    if utils.WINDOWS else
+    "${XDG_CACHE_HOME}/scdl/cache.sqlite"
+    if os.environ.get("XDG_CACHE_HOME") else
+    "${HOME}/.cache/scdl/cache.sqlite"
+)
+
 _default_config = {
     "directory"        : ".",
     "oauth_token"      : None,
@@ -26,7 +34,9 @@ _default_config = {
     "low_quality"      : False,
     "download_original": True,
     "process_original" : True,
-    "compression_level": 12
+    "compression_level": 12,
+    "cache"            : _default_cache_path,
+    "cache_size"       : 64 * 1024 * 1024
 }
 
 def get_config() -> dict:
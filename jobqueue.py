@@ -0,0 +1,187 @@
+import json
+import time
+import sqlite3
+from typing import NamedTuple
+from contextlib import contextmanager
+
+DEFAULT_LEASE = 300 # seconds, workers renew it every lease / 3 while a job is running
+_MAX_ATTEMPTS = 5
+_RETRY_DELAY = 30 # seconds before a failed job can be claimed again, doubled with every attempt
+_THROUGHPUT_WINDOW = 300
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id          INTEGER PRIMARY KEY,
+    key         TEXT    NOT NULL UNIQUE,
+    kind        TEXT    NOT NULL,
+    payload     TEXT    NOT NULL,
+    status      TEXT    NOT NULL DEFAULT 'pending',
+    worker      TEXT,
+    lease_until REAL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    not_before  REAL,
+    error       TEXT,
+    created_at  REAL    NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_until);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+class Job(NamedTuple):
+    id     : int
+    kind   : str
+    payload: dict
+    attempt: int # fencing token, renew()/ack()/fail() only match the claim that handed this out
+
+class JobQueue:
+    # sqlite file shared between processes (and hosts, if it sits on a shared filesystem)
+    # no WAL on purpose, it doesn't work over network filesystems
+    # every operation opens its own connection so it can be called from asyncio.to_thread()
+    def __init__(self, path: str, max_attempts: int = _MAX_ATTEMPTS) -> None:
+        self.path = path
+        self.max_attempts = max_attempts
+        with self._connect() as db:
+            db.executescript(_SCHEMA)
+            # queues created before retry backoff existed
+            if 'not_before' not in [x[1] for x in db.execute('PRAGMA table_info(jobs)')]:
+                db.execute('ALTER TABLE jobs ADD COLUMN not_before REAL')
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._connect() as db:
+            # IMMEDIATE takes the write lock up front so two workers can't claim the same job
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    def put_many(self, jobs: list[tuple[str, str, dict]]) -> int:
+        # jobs are (key, kind, payload), keys already in the queue are skipped so re-enqueueing is harmless
+        now = time.time()
+        with self._transaction() as db:
+            before = db.total_changes
+            db.executemany(
+                'INSERT OR IGNORE INTO jobs (key, kind, payload, created_at) VALUES (?, ?, ?, ?)',
+                [(key, kind, json.dumps(payload), now) for key, kind, payload in jobs]
+            )
+            return db.total_changes - before
+
+    def claim(self, worker: str, lease: float = DEFAULT_LEASE) -> Job | None:
+        now = time.time()
+        with self._transaction() as db:
+            # jobs whose worker died without finishing them too many times are given up on
+            db.execute(
+                "UPDATE jobs SET status = 'failed', error = 'lease expired' "
+                "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                (now, self.max_attempts)
+            )
+            row = db.execute(
+                "SELECT id, kind, payload, attempts + 1 FROM jobs "
+                "WHERE (status = 'pending' AND (not_before IS NULL OR not_before <= ?)) "
+                "OR (status = 'running' AND lease_until < ?) "
+                "ORDER BY id LIMIT 1",
+                (now, now)
+            ).fetchone()
+            if not row:
+                return None
+            db.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                (worker, now + lease, row[0])
+            )
+        return Job(row[0], row[1], json.loads(row[2]), row[3])
+
+    # renew(), ack() and fail() only apply while the claim still holds the lease, a job that expired and got
+    # reclaimed (even by the same worker) belongs to the new claim and a late result from the old one is dropped
+    def renew(self, job: Job, worker: str, lease: float = DEFAULT_LEASE) -> bool:
+        with self._transaction() as db:
+            cur = db.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND attempts = ? AND status = 'running'",
+                (time.time() + lease, job.id, worker, job.attempt)
+            )
+            return cur.rowcount > 0
+
+    def ack(self, job: Job, worker: str) -> bool:
+        with self._transaction() as db:
+            cur = db.execute(
+                "UPDATE jobs SET status = 'done', lease_until = NULL, error = NULL, finished_at = ? "
+                "WHERE id = ? AND worker = ? AND attempts = ? AND status = 'running'",
+                (time.time(), job.id, worker, job.attempt)
+            )
+            return cur.rowcount > 0
+
+    def fail(self, job: Job, worker: str, error: str) -> bool:
+        # backs off so a short outage (429s, dns) doesn't burn through every attempt in a few seconds
+        not_before = time.time() + _RETRY_DELAY * 2 ** (job.attempt - 1)
+        with self._transaction() as db:
+            cur = db.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "worker = NULL, lease_until = NULL, not_before = ?, error = ? "
+                "WHERE id = ? AND worker = ? AND attempts = ? AND status = 'running'",
+                (self.max_attempts, not_before, error, job.id, worker, job.attempt)
+            )
+            return cur.rowcount > 0
+
+    def get_meta(self, key: str) -> str | None:
+        with self._connect() as db:
+            row = db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self._transaction() as db:
+            db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def set_expanded(self, expanded: bool) -> None:
+        # the coordinator clears this before expanding urls and sets it once it's done,
+        # until then workers keep waiting for jobs even if everything queued so far is finished
+        self.set_meta('expanded', '1' if expanded else '0')
+
+    def drained(self) -> bool:
+        # nothing left to claim, nothing that could come back through lease expiry and nothing more coming
+        with self._connect() as db:
+            active = db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'running')"
+            ).fetchone()[0]
+        return self.get_meta('expanded') == '1' and not active
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._connect() as db:
+            counts = dict(db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+            recent, workers, first = db.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT worker), MIN(finished_at) FROM jobs "
+                "WHERE status = 'done' AND finished_at >= ?",
+                (now - _THROUGHPUT_WINDOW,)
+            ).fetchone()
+        # rate over the last few minutes, or since the first finished job if the crawl is younger than that
+        window = max(now - first, 60) if first else _THROUGHPUT_WINDOW
+        return {
+            'total'  : sum(counts.values()),
+            'pending': counts.get('pending', 0),
+            'running': counts.get('running', 0),
+            'done'   : counts.get('done', 0),
+            'failed' : counts.get('failed', 0),
+            'workers': workers,
+            'per_min': recent / (window / 60)
+        }
+
+def format_stats(stats: dict) -> str:
+    return (
+        f"queue: {stats['done']}/{stats['total']} done, {stats['running']} running, "
+        f"{stats['pending']} pending, {stats['failed']} failed | "
+        f"{stats['per_min']:.1f} tracks/min across {stats['workers']} worker(s)"
+    )
@@ -0,0 +1,150 @@
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+_DEFAULT_MAX_SIZE = 64 * 1024 * 1024 # bytes of cached json
+_EVICT_TO = 0.9 # evict down to this fraction of max_size so not every put has to evict
+_TOUCH_BATCH = 100 # last_used updates get written in batches of this many (or on put/close)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key           TEXT    PRIMARY KEY,
+    body          TEXT    NOT NULL,
+    size          INTEGER NOT NULL,
+    etag          TEXT,
+    last_modified TEXT,
+    expires_at    REAL    NOT NULL,
+    last_used     REAL    NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+CREATE TABLE IF NOT EXISTS total (
+    id   INTEGER PRIMARY KEY CHECK (id = 0),
+    size INTEGER NOT NULL
+);
+"""
+
+class MetadataCache:
+    # persistent api response cache, least recently used entries get evicted once it's over max_size
+    # entries past their ttl are kept around so they can be revalidated with etag/last-modified
+    # every operation opens its own connection so it can be called from asyncio.to_thread(), the file
+    # may be shared by several processes so the size total lives in the database instead of in here
+    hits       : int = 0
+    revalidated: int = 0
+    misses     : int = 0
+
+    def __init__(self, path: str, max_size: int = _DEFAULT_MAX_SIZE) -> None:
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._touched = {}
+        with self._connect() as db:
+            db.executescript(_SCHEMA)
+        with self._transaction() as db:
+            db.execute('INSERT OR IGNORE INTO total (id, size) SELECT 0, COALESCE(SUM(size), 0) FROM responses')
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    def close(self) -> None:
+        self._flush_touched()
+
+    @staticmethod
+    def make_key(url: str, params: dict, scope: str = '') -> str:
+        # scope separates responses that depend on who's asking (e.g. per account)
+        return json.dumps([scope, url, sorted((k, str(v)) for k, v in params.items())])
+
+    def get(self, key: str) -> tuple[object, bool, dict]:
+        # returns (data, fresh, conditional request headers), data is None if there's nothing cached
+        with self._connect() as db:
+            row = db.execute(
+                'SELECT body, etag, last_modified, expires_at FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+        if not row:
+            return None, False, {}
+        body, etag, last_modified, expires_at = row
+        now = time.time()
+        with self._lock:
+            self._touched[key] = now
+            flush = len(self._touched) >= _TOUCH_BATCH
+        if flush:
+            self._flush_touched()
+        if expires_at > now:
+            with self._lock:
+                self.hits += 1
+            return json.loads(body), True, {}
+        headers = {}
+        if etag: headers['If-None-Match'] = etag
+        if last_modified: headers['If-Modified-Since'] = last_modified
+        return json.loads(body), False, headers
+
+    def refresh(self, key: str, ttl: float) -> None:
+        # server said 304, keep the body for another ttl
+        with self._lock:
+            self.revalidated += 1
+        with self._transaction() as db:
+            db.execute('UPDATE responses SET expires_at = ? WHERE key = ?', (time.time() + ttl, key))
+
+    def put(self, key: str, data, ttl: float, headers: dict = None) -> None:
+        # anything that had to be fetched in full counts as a miss, stale entries included
+        with self._lock:
+            self.misses += 1
+        headers = headers or {}
+        body = json.dumps(data, separators=(',', ':'))
+        now = time.time()
+        # so eviction below goes by up to date last_used
+        self._flush_touched()
+        with self._transaction() as db:
+            old = db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            db.execute(
+                'INSERT OR REPLACE INTO responses (key, body, size, etag, last_modified, expires_at, last_used) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, body, len(body), headers.get('ETag'), headers.get('Last-Modified'), now + ttl, now)
+            )
+            db.execute('UPDATE total SET size = size + ? WHERE id = 0', (len(body) - (old[0] if old else 0),))
+            self._evict(db)
+
+    def _flush_touched(self) -> None:
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        if not touched:
+            return
+        with self._transaction() as db:
+            db.executemany(
+                'UPDATE responses SET last_used = MAX(last_used, ?) WHERE key = ?',
+                [(used, key) for key, used in touched.items()]
+            )
+
+    def _evict(self, db: sqlite3.Connection) -> None:
+        total = db.execute('SELECT size FROM total WHERE id = 0').fetchone()[0]
+        if total <= self.max_size:
+            return
+        target = total - self.max_size * _EVICT_TO
+        freed = 0
+        keys = []
+        for key, size in db.execute('SELECT key, size FROM responses ORDER BY last_used'):
+            keys.append((key,))
+            freed += size
+            if freed >= target: break
+        db.executemany('DELETE FROM responses WHERE key = ?', keys)
+        db.execute('UPDATE total SET size = size - ? WHERE id = 0', (freed,))
+
+    def format_stats(self) -> str:
+        return f"metadata cache: {self.hits} hits, {self.revalidated} revalidated, {self.misses} misses"
@@ -4,13 +4,20 @@ import os
 import re
 import sys
 import json
+import time
 import utils
 import base64
 import config
 import shutil
+import socket
 import aiohttp
 import asyncio
+import hashlib
+import sqlite3
 import aiofiles
+import jobqueue
+import metacache
+import urllib.parse
 from argparse import ArgumentParser
 
 from mutagen.oggopus import OggOpus
@@ -21,6 +28,18 @@ from mutagen.id3 import ID3, TIT2, TRCK, TALB, TPE1, TPE2, TDRC, COMM, APIC, TCO
 
 _CONCURRENT_TRACKS = 2
 _CONCURRENT_SEGMENTS = 8
+_QUEUE_POLL = 5
+_QUEUE_REPORT = 60
+# seconds a cached api response is used without asking the server, 0 = always revalidate
+# tracks and collection pages are what downloads run off of so they always get revalidated (cheap if the server
+# says 304), resolve responses are served straight from the cache for a while but with _CACHE_VOLATILE stripped
+_CACHE_TTLS = {
+    'collection': 0,
+    'resolve'   : 60 * 60,
+    'tracks'    : 0
+}
+# fields that can go stale without the rest of the track changing (stream urls, download quota)
+_CACHE_VOLATILE = ['media', 'has_downloads_left', 'track_authorization']
 _LOSSLESS_REGEX = r"alac|ape|flac|pcm_(f|s|u).+"
 _EXT_MAP = {
     'aac'   : 'm4a',
@@ -55,6 +74,7 @@ class SoundCloudDL:
     download_original: bool = True
     process_original : bool = True
     compression_level: int  = 12
+    metadata_cache   : metacache.MetadataCache = None
     
     def __init__(self) -> None:
         for executable in ['ffmpeg', 'ffprobe']:
@@ -123,33 +143,53 @@ class SoundCloudDL:
         for task in tasks:
             if not task.done(): task.cancel()
 
-    async def _resolve_url(self, url: str) -> dict:
-        async with self._session.get(
-            "https://api-v2.soundcloud.com/resolve",
-            params={
-                "url": url,
-                "client_id": self._client_id
-            }
-        ) as r:
+    async def _get_json(self, url: str, params: dict, ttl: float):
+        # query string goes into params so it ends up in the cache key the same way no matter where it came from
+        url, _, query = url.partition('?')
+        params = {**dict(urllib.parse.parse_qsl(query, keep_blank_values=True)), **params, "client_id": self._client_id}
+        if not self.metadata_cache:
+            async with self._session.get(url, params=params) as r:
+                return await r.json()
+
+        # client_id changes between runs so it's left out of the key, the account isn't since it changes what we get
+        scope = hashlib.sha1(self.oauth_token.encode()).hexdigest() if self.oauth_token else ''
+        key = self.metadata_cache.make_key(url, {k: v for k, v in params.items() if k != 'client_id'}, scope)
+        cached, fresh, headers = await asyncio.to_thread(self.metadata_cache.get, key)
+        if fresh:
+            # nobody checked this against the server, so _download_track has to re-fetch the track before using it
+            return self._strip_volatile(cached)
+
+        async with self._session.get(url, params=params, headers=headers) as r:
+            if r.status == 304:
+                await asyncio.to_thread(self.metadata_cache.refresh, key, ttl)
+                return cached
             data = await r.json()
+            if r.status == 200:
+                await asyncio.to_thread(self.metadata_cache.put, key, data, ttl, r.headers)
+        return data
+
+    def _strip_volatile(self, data):
+        if isinstance(data, list):
+            return [self._strip_volatile(x) for x in data]
+        if isinstance(data, dict):
+            return {k: self._strip_volatile(v) for k, v in data.items() if k not in _CACHE_VOLATILE}
         return data
+
+    async def _resolve_url(self, url: str) -> dict:
+        return await self._get_json("https://api-v2.soundcloud.com/resolve", {"url": url}, _CACHE_TTLS['resolve'])
     
     async def _get_track(self,
         track_id: int, secret_token = None,
         playlist_id: int = None, playlist_token: str = None
     ) -> dict:
-        params = {"client_id": self._client_id, "ids": track_id} 
+        params = {"ids": track_id}
         if secret_token:
             params.update({'secret_token': secret_token})
         if playlist_id and playlist_token:
             params.update({
                 'playlistId': playlist_id, 'playlistSecretToken': playlist_token
             })
-        async with self._session.get(
-            f"https://api-v2.soundcloud.com/tracks",
-            params=params
-        ) as r:
-            data = await r.json()
+        data = await self._get_json("https://api-v2.soundcloud.com/tracks", params, _CACHE_TTLS['tracks'])
         return data[0]
     
     async def _clean_url(self, url: str) -> str:
@@ -422,9 +462,44 @@ class SoundCloudDL:
         print(f"{data['title']} ({f'{og_codec}->{codec}' if lossless else f'direct-dl {og_codec}' if og_codec else codec})")
         return True
 
-    async def _download_playlist(self, data: dict):
+    def _track_job(self, key: str, data: dict, **kwargs) -> tuple[str, str, dict]:
+        # only what's needed to re-fetch the track, stream urls in 'media' would be stale by the time a worker gets to it
+        data = {x: data[x] for x in ['id', 'secret_token', 'title'] if data.get(x)}
+        return (key, 'track', {'data': data, **kwargs})
+
+    def _queue_subdir(self, queue: jobqueue.JobQueue, key: str, name: str) -> str:
+        # a playlist/collection keeps the directory it got the first time it was enqueued,
+        # otherwise every re-enqueue would pick (and create) a new "name (n)" one
+        subdir = queue.get_meta(f"subdir/{key}")
+        if not subdir:
+            subdir = os.path.basename(utils.unique_path(f"{self.directory}/{utils.fix_fn(name)}", False))
+            # claim the directory now, the tracks may not get downloaded before the next playlist is expanded
+            os.makedirs(f"{self.directory}/{subdir}", exist_ok=True)
+            queue.set_meta(f"subdir/{key}", subdir)
+        return subdir
+
+    async def _download_playlist(self, data: dict, queue: jobqueue.JobQueue = None):
         album_artist = data['user']['username']
         album = data['title']
+
+        if queue:
+            subdir = self._queue_subdir(queue, f"playlist/{data['id']}", f'{album_artist} - {album}')
+            jobs = [
+                self._track_job(
+                    f"playlist/{data['id']}/{track_data['id']}", track_data,
+                    subdir=subdir,
+                    album=album, album_artist=album_artist, track=(i, len(data['tracks'])),
+                    playlist_id=data['id'], playlist_token=data['secret_token']
+                ) for i, track_data in enumerate(data['tracks'], 1)
+            ]
+            if data['artwork_url']:
+                cover_url = await self._get_cover_url(data)
+                jobs.append((f"playlist/{data['id']}/cover", 'file', {
+                    'url': cover_url, 'dest': f"{subdir}/cover.{cover_url.rpartition('.')[-1]}"
+                }))
+            print(f"{album} - queued {queue.put_many(jobs)} new jobs")
+            return
+
         subdir = os.path.basename(utils.unique_path(f"{self.directory}/{utils.fix_fn(f'{album_artist} - {album}')}", False))
 
         tasks = set()
@@ -450,17 +525,16 @@ class SoundCloudDL:
     
     async def _collection_gen(self, url: str):
         while True:
-            async with self._session.get(url, params={'client_id': self._client_id}) as r:
-                data = await r.json()
-                if not data['next_href']:
-                    return
-                
-                for track in data['collection']:
-                    yield track
-                
-                url = data['next_href'].replace('://http_backend/', '://api-v2.soundcloud.com/', 1)
+            data = await self._get_json(url, {}, _CACHE_TTLS['collection'])
+            if not data['next_href']:
+                return
+            
+            for track in data['collection']:
+                yield track
+            
+            url = data['next_href'].replace('://http_backend/', '://api-v2.soundcloud.com/', 1)
 
-    async def _download_collection(self, data: dict, type: str = 'user') -> None:
+    async def _download_collection(self, data: dict, type: str = 'user', queue: jobqueue.JobQueue = None) -> None:
         match type:
             case 'user':
                 url = f"https://api-v2.soundcloud.com/users/{data['id']}/tracks?limit=100"
@@ -473,15 +547,22 @@ class SoundCloudDL:
                 subdir = data['username'] + ' - likes'
             case _:
                 raise ValueError(f"'{type}' is not a valid/supported collection type")
-        subdir = os.path.basename(utils.unique_path(f"{self.directory}/{utils.fix_fn(subdir)}", False))
+        if queue:
+            subdir = self._queue_subdir(queue, f"{type}/{data['id']}", subdir)
+        else:
+            subdir = os.path.basename(utils.unique_path(f"{self.directory}/{utils.fix_fn(subdir)}", False))
         
         tasks = set()
+        jobs = []
         i = 1
         async for track_data in self._collection_gen(url):
             if type != 'user':
                 if not 'track' in track_data:
                     continue
                 track_data = track_data['track']
+            if queue:
+                jobs.append(self._track_job(f"{type}/{data['id']}/{track_data['id']}", track_data, subdir=subdir))
+                continue
             if len(tasks) >= _CONCURRENT_TRACKS:
                 _, tasks = await asyncio.wait(
                     tasks, return_when=asyncio.FIRST_COMPLETED
@@ -489,9 +570,13 @@ class SoundCloudDL:
             tasks.add(asyncio.create_task(
                 self._download_track(track_data, subdir)
             ))
+        if queue:
+            print(f"{data['username']} ({type}) - queued {queue.put_many(jobs)} new jobs")
+            return
         await asyncio.wait(tasks)
 
-    async def download(self, url: str) -> None:
+    async def download(self, url: str, queue: jobqueue.JobQueue = None) -> None:
+        # with a queue, tracks are only expanded into jobs for workers (see work()) instead of downloaded
         if not self._session:
             raise SCSessionClosedError("soundcloud session wasn't opened, use 'async with' construct")
         
@@ -511,12 +596,118 @@ class SoundCloudDL:
             raise SCIncorrectUrlException(f"{url} could not be resolved, is it correct?")
         
         match link_type:
+            case "track" if queue:
+                queue.put_many([self._track_job(f"track/{resolved['id']}", resolved)])
             case "track":
                 await self._download_track(resolved)
             case "playlist":
-                await self._download_playlist(resolved)
+                await self._download_playlist(resolved, queue)
             case "user" | "reposts" | "likes":
-                await self._download_collection(resolved, link_type)
+                await self._download_collection(resolved, link_type, queue)
+
+    async def _heartbeat(self,
+        queue: jobqueue.JobQueue, worker: str, job: jobqueue.Job, lease: float, download: asyncio.Task
+    ) -> None:
+        # once the lease is lost another worker owns the job, so the download gets cancelled
+        # to keep it from ending up on disk twice
+        renewed = time.monotonic()
+        while True:
+            await asyncio.sleep(lease / 3)
+            try:
+                if await asyncio.to_thread(queue.renew, job, worker, lease):
+                    renewed = time.monotonic()
+                    continue
+            except sqlite3.OperationalError as e:
+                # queue locked/unreachable for now, the lease is still ours until it runs out
+                print(f"couldn't renew lease on job {job.id}: {e}")
+                if time.monotonic() - renewed < lease:
+                    continue
+            download.cancel()
+            return
+
+    async def _do_job(self, job: jobqueue.Job) -> None:
+        match job.kind:
+            case 'track':
+                kwargs = job.payload.copy()
+                if kwargs.get('track'):
+                    kwargs['track'] = tuple(kwargs['track'])
+                await self._download_track(**kwargs)
+            case 'file':
+                dest = f"{self.directory}/{job.payload['dest']}"
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                await self._download_file(job.payload['url'], dest)
+            case _:
+                raise ValueError(f"'{job.kind}' is not a valid job kind")
+
+    async def _queue_call(self, func, *args, retry_for: float = 0):
+        # a queue on a shared filesystem can stay locked past sqlite's busy timeout, that shouldn't take the
+        # worker down with it, returns None if the call still fails after retry_for seconds
+        deadline = time.monotonic() + retry_for
+        while True:
+            try:
+                return await asyncio.to_thread(func, *args)
+            except sqlite3.OperationalError as e:
+                print(f"job queue unavailable: {e}")
+                if time.monotonic() >= deadline:
+                    return None
+                await asyncio.sleep(_QUEUE_POLL)
+
+    async def _run_job(self, queue: jobqueue.JobQueue, worker: str, job: jobqueue.Job, lease: float) -> None:
+        download = asyncio.create_task(self._do_job(job))
+        heartbeat = asyncio.create_task(self._heartbeat(queue, worker, job, lease, download))
+        try:
+            await download
+        except asyncio.CancelledError:
+            # heartbeat only finishes by cancelling the download, anything else is this task being cancelled
+            if not heartbeat.done():
+                raise
+            print(f"job {job.id} lost its lease, dropped")
+        except Exception as e:
+            print(f"job {job.id} failed: {e!r}")
+            # keep trying for as long as the lease lasts, after that the job is someone else's anyway
+            if await self._queue_call(queue.fail, job, worker, repr(e), retry_for=lease) is None:
+                print(f"couldn't record failure of job {job.id}, it'll be retried once its lease expires")
+        else:
+            if await self._queue_call(queue.ack, job, worker, retry_for=lease) is None:
+                print(f"couldn't ack job {job.id}, it'll be downloaded again once its lease expires")
+        finally:
+            heartbeat.cancel()
+
+    async def work(self, queue: jobqueue.JobQueue, lease: float = jobqueue.DEFAULT_LEASE) -> None:
+        # claim and download jobs until the queue is drained
+        # any number of these can run against the same queue, from this or other hosts
+        if not self._session:
+            raise SCSessionClosedError("soundcloud session wasn't opened, use 'async with' construct")
+
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+        print(f"\nworking as {worker}")
+        tasks = set()
+        last_report = time.monotonic()
+        while True:
+            while len(tasks) < _CONCURRENT_TRACKS:
+                job = await self._queue_call(queue.claim, worker, lease)
+                if not job: break
+                tasks.add(asyncio.create_task(self._run_job(queue, worker, job, lease)))
+
+            if tasks:
+                done, tasks = await asyncio.wait(
+                    tasks, timeout=_QUEUE_POLL, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if not task.cancelled() and task.exception():
+                        print(f"worker task crashed: {task.exception()!r}")
+            elif await self._queue_call(queue.drained):
+                break
+            else:
+                # nothing claimable right now, either not enqueued yet or leased by other workers
+                await asyncio.sleep(_QUEUE_POLL)
+
+            if time.monotonic() - last_report >= _QUEUE_REPORT:
+                stats = await self._queue_call(queue.stats)
+                if stats: print(jobqueue.format_stats(stats))
+                last_report = time.monotonic()
+        stats = await self._queue_call(queue.stats)
+        if stats: print(jobqueue.format_stats(stats))
 
 #---------------------------------------------------------#
 
@@ -525,7 +716,7 @@ async def _cli(argv: list) -> None:
     cfg = config.get_config()
     
     parser = ArgumentParser()
-    parser.add_argument('url', nargs='+', type=str)
+    parser.add_argument('url', nargs='*', type=str)
     parser.add_argument('-o', '--directory', type=str, help='download directory')
     parser.add_argument('-a', '--oauth-token', type=str, help='account token; format: X-XXXXXX-XXXXXXXXXX-XXXXXXXXXXXXX')
     parser.add_argument('-O', '--prefer-opus', action='store_true', help="prefer 64 kbps opus over 128 kbps mp3")
@@ -537,7 +728,23 @@ async def _cli(argv: list) -> None:
     parser.add_argument('-p', '--process-original', action='store_true', help="convert lossless to flac and tag original files (default)")
     parser.add_argument('-P', '--dont-process-original', action='store_true', help="leave original files untouched")
     parser.add_argument('-c', '--compression-level', type=int, choices=[x for x in range(13)], help='flac compression level (default = 12)')
+    parser.add_argument('-q', '--queue', type=str, help="job queue file; urls get expanded into per-track jobs in it instead of being downloaded")
+    parser.add_argument('-w', '--work', action='store_true', help="download jobs from --queue until it's drained, run as many as you want")
+    parser.add_argument('--cache', type=str, help="metadata cache file")
+    parser.add_argument('--no-cache', action='store_true', help="don't cache api responses")
+    parser.add_argument('-s', '--queue-stats', action='store_true', help="print --queue progress and throughput, then quit")
     args = parser.parse_args(argv)
+
+    if (args.work or args.queue_stats) and not args.queue:
+        print('error: --work and --queue-stats require --queue, quitting')
+        return
+    if not args.url and not args.work and not args.queue_stats:
+        print('error: no urls were specified, quitting')
+        return
+    queue = jobqueue.JobQueue(args.queue) if args.queue else None
+    if args.queue_stats:
+        print(jobqueue.format_stats(queue.stats()))
+        return
     
     scdl.directory = args.directory if args.directory else cfg['directory']
     scdl.oauth_token = args.oauth_token if args.oauth_token else cfg['oauth_token']
@@ -583,14 +790,43 @@ async def _cli(argv: list) -> None:
         scdl.process_original = False
     else:
         scdl.process_original = cfg['process_original']
+
+    if args.cache and args.no_cache:
+        print('error: both --cache and --no-cache were specified, quitting')
+        return
     # awful part over ((relief))
 
-    async with scdl as s:
-        for url in args.url:
+    cache_path = args.cache if args.cache else cfg['cache']
+    if cache_path and not args.no_cache:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        scdl.metadata_cache = metacache.MetadataCache(cache_path, cfg['cache_size'])
+
+    try:
+        async with scdl as s:
+            if queue and args.url:
+                queue.set_expanded(False)
             try:
-                await scdl.download(url)
-            except SCIncorrectUrlException as e:
-                print(e)
+                for url in args.url:
+                    try:
+                        await scdl.download(url, queue)
+                    except SCIncorrectUrlException as e:
+                        print(e)
+                    except Exception as e:
+                        if not queue:
+                            raise
+                        # one url failing to expand shouldn't keep the rest out of the queue
+                        print(f"couldn't expand {url}: {e!r}")
+            finally:
+                # always let workers know nothing more is coming, even if expansion died halfway,
+                # otherwise they'd wait on the queue forever (re-run with the same urls to fill in the rest)
+                if queue and args.url:
+                    queue.set_expanded(True)
+            if args.work:
+                await scdl.work(queue)
+    finally:
+        if scdl.metadata_cache:
+            print(scdl.metadata_cache.format_stats())
+            scdl.metadata_cache.close()
 
 def cli_run(args: list = sys.argv[1:]) -> None:
     asyncio.run(_cli(args))